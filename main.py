@@ -12,22 +12,23 @@ Activity Logger (Tray Version v2.3)
 """
 
 import time
-import csv
 import threading
 import os
 import sys
 import uuid
 import json
-import psutil
+import io
+import base64
+import queue
+import ctypes
+from ctypes import wintypes
 import win32gui
 import win32process
-from PIL import Image, ImageDraw
-import pystray
+# PIL / pystray は多重起動チェック後に必要になった時点で読み込む（起動の高速化）
 
 # ★ミューテックス（多重起動防止）のためにインポートを追加
 import win32event
 import win32api
-import pywintypes
 import winerror  # ★修正点 1: winerror をインポート
 
 # ===============================
@@ -69,7 +70,7 @@ def check_already_running_mutex():
         sys.exit(1)
 
 
-# ★元の check_already_running() の代わりにミューテックス版を呼び出す
+# プロセスを走査せず、名前付きミューテックス（カーネル呼び出し1回）で多重起動を判定
 check_already_running_mutex()
 
 # ===============================
@@ -77,137 +78,429 @@ check_already_running_mutex()
 # ===============================
 SETTINGS_FILE = "settings.json"
 DEFAULT_INTERVAL = 3
+SETTINGS_SAVE_DELAY_SEC = 1.0  # 設定変更から保存までの待ち時間（連続変更をまとめる）
 MAX_REPEAT_SEC = 300  # 同一ウィンドウ再記録の最長間隔
-stop_flag = False
+FLUSH_INTERVAL_SEC = 60  # バッファをディスクへ書き出す最長間隔
+LOG_QUEUE_SIZE = 1024
+MAX_BATCH = 256  # 1回の write にまとめる最大行数
+stop_event = threading.Event()
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)  # ロガー → 書き込みスレッド（None で終了）
 SESSION_ID = str(uuid.uuid4())[:8]
 
+BASE_DIR = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(
+    os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, "Logs")
+CSV_HEADER = "\ufeffsession,id,timestamp,exe,title\r\n".encode("utf-8")  # BOM付き（Excel互換）
+os.makedirs(LOG_DIR, exist_ok=True)
+
 
 # ===============================
 # 設定ロード・保存
 # ===============================
+last_saved_settings = None  # settings.json に保存済みの内容
+
+
 def load_settings():
+    global last_saved_settings
     if os.path.exists(SETTINGS_FILE):
         try:
             with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                loaded = json.load(f)
+            last_saved_settings = dict(loaded)
+            return loaded
         except Exception:
             pass
     return {"interval": DEFAULT_INTERVAL}
 
 
 def save_settings(settings):
-    with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
+    global last_saved_settings
+    if settings == last_saved_settings:
+        return
+    # 一時ファイルに書いてから置き換え、書き込み途中で落ちても壊れないようにする
+    tmp_file = SETTINGS_FILE + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
         json.dump(settings, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, SETTINGS_FILE)
+    last_saved_settings = dict(settings)
 
 
 settings = load_settings()
 interval_value = settings.get("interval", DEFAULT_INTERVAL)
-interval_lock = threading.Lock()
+interval_lock = threading.Lock()  # 書き込み側（set_interval）のみで使用
+save_timer = None
 
 
 # ===============================
 # ユーティリティ
 # ===============================
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+PROCESS_MODE_BACKGROUND_END = 0x00200000
+
+user32 = ctypes.windll.user32
+kernel32 = ctypes.windll.kernel32
+
+kernel32.OpenProcess.argtypes = [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+kernel32.OpenProcess.restype = wintypes.HANDLE
+kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+kernel32.QueryFullProcessImageNameW.argtypes = [wintypes.HANDLE, wintypes.DWORD, wintypes.LPWSTR,
+                                                ctypes.POINTER(wintypes.DWORD)]
+kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+kernel32.SetPriorityClass.argtypes = [wintypes.HANDLE, wintypes.DWORD]
+
+
+def set_background_mode(enabled):
+    # バックグラウンドモードではCPU/I/Oのスケジューリング優先度が下がり、前面の作業を邪魔しない
+    mode = PROCESS_MODE_BACKGROUND_BEGIN if enabled else PROCESS_MODE_BACKGROUND_END
+    if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), mode):
+        print(f"[WARN] 優先度を変更できませんでした: {ctypes.WinError()}")
+
+
+def open_process(pid):
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        raise ctypes.WinError()
+    return handle
+
+
+last_window = None  # 直前のサンプルの (hwnd, pid, exe)
+
+
+def exe_for_pid(pid):
+    handle = open_process(pid)
+    try:
+        buf = ctypes.create_unicode_buffer(1024)
+        size = wintypes.DWORD(len(buf))
+        if not kernel32.QueryFullProcessImageNameW(handle, 0, buf, ctypes.byref(size)):
+            raise ctypes.WinError()
+        return os.path.basename(buf.value)
+    finally:
+        kernel32.CloseHandle(handle)
+
+
 def get_active_window_info():
+    global last_window
     try:
         hwnd = win32gui.GetForegroundWindow()
         if hwnd:
             _, pid = win32process.GetWindowThreadProcessId(hwnd)
-            process = psutil.Process(pid)
             title = win32gui.GetWindowText(hwnd)
-            exe = process.name()
+            # 同じウィンドウが続く間はプロセスを開かない
+            if last_window and last_window[:2] == (hwnd, pid):
+                exe = last_window[2]
+            else:
+                exe = exe_for_pid(pid)
+                last_window = (hwnd, pid, exe)
             return exe, title
     except Exception:
         pass
     return None, None
 
 
-def safe_open_log():
+# 追記専用・順次アクセスのヒント付きで開く（O_SEQUENTIAL/O_BINARY は Windows のみ）
+LOG_OPEN_FLAGS = os.O_WRONLY | os.O_APPEND | getattr(os, "O_SEQUENTIAL", 0) | getattr(os, "O_BINARY", 0)
+
+
+def safe_open_log(path):
+    """ログを追記用に開き、(ファイル, 新規作成したか) を返す"""
     for _ in range(3):
         try:
-            return open(current_log_path(), "a", newline="", encoding="utf-8-sig")
+            # 新規作成を O_EXCL で判定し、ヘッダ要否のための stat を省く
+            try:
+                fd, created = os.open(path, LOG_OPEN_FLAGS | os.O_CREAT | os.O_EXCL, 0o644), True
+            except FileExistsError:
+                fd = os.open(path, LOG_OPEN_FLAGS)
+                # ヘッダ書き込み前に強制終了された空ファイルは新規扱いにする
+                created = os.fstat(fd).st_size == 0
+            return os.fdopen(fd, "ab", buffering=8192), created
         except PermissionError:
             time.sleep(1)
     raise PermissionError("ログファイルにアクセスできませんでした。")
 
 
+def csv_escape(s):
+    # 列構成は固定なので csv.writer を通さず、必要なときだけクォートする
+    if not any(c in s for c in ',"\r\n'):
+        return s
+    return '"' + s.replace('"', '""') + '"'
+
+
+cached_log_path = None
+cached_log_path_start = 0  # 現在の6時間区切りの開始epoch秒
+cached_log_path_expiry = 0  # 次の6時間区切りのepoch秒
+
+
 def current_log_path():
-    now = time.localtime()
-    base_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(
-        os.path.abspath(__file__))
-    log_dir = os.path.join(base_dir, "Logs")
-    os.makedirs(log_dir, exist_ok=True)
-    hour_block = (now.tm_hour // 6) * 6
-    return os.path.join(log_dir, f"activity_{time.strftime('%Y-%m-%d')}_{hour_block:02d}h.csv")
+    global cached_log_path, cached_log_path_start, cached_log_path_expiry
+    now = time.time()
+    # 時計が巻き戻された（手動補正・タイムゾーン変更）場合も作り直す
+    if cached_log_path_start <= now < cached_log_path_expiry:
+        return cached_log_path
+    t = time.localtime(now)
+    hour_block = (t.tm_hour // 6) * 6
+    cached_log_path = os.path.join(
+        LOG_DIR, f"activity_{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}_{hour_block:02d}h.csv")
+    # mktime は時刻の繰り上がり（24時 → 翌日0時）も正規化する
+    cached_log_path_start = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hour_block, 0, 0, 0, 0, -1))
+    cached_log_path_expiry = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hour_block + 6, 0, 0, 0, 0, -1))
+    return cached_log_path
+
+
+# ===============================
+# ウィンドウ切替フック
+# ===============================
+EVENT_SYSTEM_FOREGROUND = 0x0003
+EVENT_OBJECT_NAMECHANGE = 0x800C
+WINEVENT_OUTOFCONTEXT = 0x0000
+WINEVENT_SKIPOWNPROCESS = 0x0002
+OBJID_WINDOW = 0
+CHILDID_SELF = 0
+WM_QUIT = 0x0012
+WINEVENT_FLAGS = WINEVENT_OUTOFCONTEXT | WINEVENT_SKIPOWNPROCESS
+
+wake_event = threading.Event()  # アクティブウィンドウ/タイトルの変化通知
+hook_active = False
+hook_thread_id = None
+title_hook = None  # フォアグラウンドウィンドウのスレッドに限定したタイトル変更フック
+title_hook_hwnd = None
+
+WinEventProc = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+                                  wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+user32.SetWinEventHook.argtypes = [wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, WinEventProc,
+                                   wintypes.DWORD, wintypes.DWORD, wintypes.DWORD]
+user32.SetWinEventHook.restype = wintypes.HANDLE
+user32.UnhookWinEvent.argtypes = [wintypes.HANDLE]
+
+
+def watch_title_of(hwnd):
+    """タイトル変更フックを hwnd を所有するプロセス/スレッドだけに張り直す（フックスレッドから呼ぶ）"""
+    global title_hook, title_hook_hwnd
+    if title_hook:
+        user32.UnhookWinEvent(title_hook)
+        title_hook = None
+    title_hook_hwnd = None
+    if not hwnd:
+        return
+    thread_id, pid = win32process.GetWindowThreadProcessId(hwnd)
+    # 通知が届いた時点で破棄済みのウィンドウ（Alt+Tab 等）は thread_id が 0 になる。
+    # 0 のまま登録すると全スレッド対象のフックになるため登録しない
+    if not thread_id:
+        return
+    title_hook_hwnd = hwnd
+    title_hook = user32.SetWinEventHook(EVENT_OBJECT_NAMECHANGE, EVENT_OBJECT_NAMECHANGE, None,
+                                        win_event_proc, pid, thread_id, WINEVENT_FLAGS)
+
+
+def on_win_event(hook, event, hwnd, id_object, id_child, event_thread, event_time):
+    if event == EVENT_SYSTEM_FOREGROUND:
+        if hwnd != title_hook_hwnd:
+            watch_title_of(hwnd)
+    # タイトル変更はフォアグラウンドウィンドウ自身のものだけを対象にする
+    elif id_object != OBJID_WINDOW or id_child != CHILDID_SELF or hwnd != title_hook_hwnd:
+        return
+    wake_event.set()
+
+
+# ★コールバックがGCで解放されないようグローバルに保持
+win_event_proc = WinEventProc(on_win_event)
+
+
+def hook_thread():
+    """WinEventフックを登録し、メッセージループを回す（フックは登録スレッドで配送される）"""
+    global hook_active, hook_thread_id
+    hook_thread_id = kernel32.GetCurrentThreadId()
+    foreground_hook = user32.SetWinEventHook(EVENT_SYSTEM_FOREGROUND, EVENT_SYSTEM_FOREGROUND, None,
+                                             win_event_proc, 0, 0, WINEVENT_FLAGS)
+    if not foreground_hook:
+        print("[WARN] WinEventフックを登録できませんでした。一定間隔の記録に切り替えます。")
+        return
+    watch_title_of(win32gui.GetForegroundWindow())
+
+    hook_active = True
+    msg = wintypes.MSG()
+    while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+        user32.TranslateMessage(ctypes.byref(msg))
+        user32.DispatchMessageW(ctypes.byref(msg))
+    hook_active = False
+    watch_title_of(None)
+    user32.UnhookWinEvent(foreground_hook)
+
+
+# ===============================
+# 書き込みスレッド
+# ===============================
+def format_row(seq_id, timestamp, exe, title):
+    return f"{SESSION_ID},{seq_id},{timestamp},{csv_escape(exe)},{csv_escape(title)}\r\n".encode("utf-8")
+
+
+def writer_thread():
+    """キューに溜まった行をまとめてファイルへ書き出す（ローテーションもここで行う）"""
+    current_file = None
+    current_path = None
+    seq_id = 0
+    last_flush_time = time.time()
+    dirty = False  # flush していない書き込みがあるか
+    running = True
+
+    while running:
+        # 未 flush のデータがある間だけ、次の flush 時刻でタイムアウトさせる
+        timeout = max(0, last_flush_time + FLUSH_INTERVAL_SEC - time.time()) if dirty else None
+        try:
+            batch = [log_queue.get(timeout=timeout)]
+        except queue.Empty:
+            batch = []
+        try:
+            while len(batch) < MAX_BATCH:
+                batch.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        # 終了指示は書き込みの成否に関わらず先に拾う
+        if None in batch:
+            running = False
+            batch = batch[:batch.index(None)]
+
+        written = 0
+        try:
+            parts = []
+            for log_path, timestamp, exe, title in batch:
+                if log_path != current_path:
+                    if parts:
+                        current_file.write(b"".join(parts))
+                        written += len(parts)
+                        dirty = True
+                        parts = []
+                    new_file, created = safe_open_log(log_path)
+                    if current_file:
+                        current_file.close()
+                    current_file, current_path = new_file, log_path
+                    if created:
+                        current_file.write(CSV_HEADER)
+                        current_file.flush()  # ヘッダだけはすぐにディスクへ
+                    seq_id = 0
+                seq_id += 1
+                parts.append(format_row(seq_id, timestamp, exe, title))
+            if parts:
+                current_file.write(b"".join(parts))
+                written += len(parts)
+                dirty = True
+
+            # 1行ごとの flush はせず、一定間隔でまとめて書き出す
+            now = time.time()
+            if not dirty:
+                last_flush_time = now
+            elif now - last_flush_time >= FLUSH_INTERVAL_SEC:
+                current_file.flush()
+                last_flush_time = now
+                dirty = False
+
+        except Exception as e:
+            dropped = len(batch) - written
+            print(f"[WARN] ログ書き込み中に例外: {e}" + (f"（{dropped} 件を破棄）" if dropped else ""))
+            # 書き込み/flush が失敗し続けても空回りしないよう、次の flush まで待たせる
+            last_flush_time = time.time()
+            time.sleep(1)
+
+    # close() で未書き込みのバッファも書き出される
+    if current_file:
+        current_file.close()
 
 
 # ===============================
 # ロガースレッド
 # ===============================
 def logger_thread():
-    global stop_flag
-    last_exe, last_title = None, None
+    last_key = None  # 直前に記録した (exe, title)
     last_write_time = 0
-    current_file = None
-    writer = None
-    seq_id = 0
+    last_ts_int, last_ts_str = 0, ""
     current_path = None
 
-    while not stop_flag:
+    while not stop_event.is_set():
         try:
+            wake_event.clear()
             log_path = current_log_path()
             if log_path != current_path:
-                if current_file:
-                    current_file.close()
-                current_file = safe_open_log()
-                writer = csv.writer(current_file)
-                if os.stat(log_path).st_size == 0:
-                    writer.writerow(["session", "id", "timestamp", "exe", "title"])
-                seq_id = 0
+                # 新しいファイルの先頭には現在のウィンドウを必ず記録する
                 current_path = log_path
-                last_exe, last_title, last_write_time = None, None, 0
+                last_key, last_write_time = None, 0
 
             exe, title = get_active_window_info()
             now = time.time()
-            with interval_lock:
-                sleep_int = interval_value
-            if exe != last_exe or title != last_title or (now - last_write_time > MAX_REPEAT_SEC):
-                seq_id += 1
-                timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-                writer.writerow([SESSION_ID, seq_id, timestamp, exe or "", title or ""])
-                current_file.flush()
-                last_exe, last_title, last_write_time = exe, title, now
-
-            time.sleep(sleep_int)
+            sleep_int = interval_value  # int の参照はGIL下でアトミックなのでロック不要
+            key = (exe, title)
+            # 取得失敗（ロック画面・UAC等）は記録しない
+            captured = exe is not None or title is not None
+            if captured and (key != last_key or now - last_write_time > MAX_REPEAT_SEC):
+                # タイムスタンプ文字列は秒が変わったときだけ組み立て直す
+                now_int = int(now)
+                if now_int != last_ts_int:
+                    t = time.localtime(now_int)
+                    last_ts_str = (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} "
+                                   f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}")
+                    last_ts_int = now_int
+                try:
+                    log_queue.put_nowait((log_path, last_ts_str, exe or "", title or ""))
+                    last_key, last_write_time = key, now
+                except queue.Full:
+                    # 記録済み扱いにせず、次のサンプルで再度記録を試みる
+                    print("[WARN] 書き込みが滞っているため記録を1件破棄しました。")
+
+            # 記録間隔は連続した切替をまとめる最短間隔として使う
+            stop_event.wait(sleep_int)
+            # フック有効時はウィンドウ切替・再記録間隔・ファイル切替時刻のいずれかまで待機（ポーリングしない）
+            if hook_active:
+                wake_event.wait(max(0, min(MAX_REPEAT_SEC, cached_log_path_expiry - time.time())))
 
         except Exception as e:
             print(f"[WARN] ログ記録中に例外: {e}")
-            time.sleep(1)
+            stop_event.wait(1)
 
-    if current_file:
-        current_file.close()
+    log_queue.put(None)
 
 
 # ===============================
 # トレイメニュー構成
 # ===============================
+# 64x64 の青地に白い円（旧: PIL の ImageDraw で毎回描画していたものと同一画像）
+ICON_PNG = base64.b64decode(
+    b"iVBORw0KGgoAAAANSUhEUgAAAEAAAABACAIAAAAlC+aJAAABCklEQVR42u2aQRbCIAwF8T/OoUf0KnpET6ILlwoFEpJAf7ZqMkPCq225XB/v"
+    b"tHIgLR4UoAAFKOAbeUbS17340e0ZVaACXfqaikw2Qy/9UKiRXdAVNeBLL8+W3dGFrUAQ+uH8CEU/UAXR6HtrISB9V8Vz/BeyX/72ughL31h99xHy"
+    b"Xf4Whq07EGH5D0l4S0mBWQJxNkCdhyNEAQpQgAIU+BvqT2GFUeLhCFFgokCcbVAh2X2EIjShznCCTezbhMPqUMniRX+m64B9ExorQj2jJX33CNk4"
+    b"dFXB1Oyz6dPYa9ZvDfUHR2NLA+N66tmyvKqwFZ5nJYQaUU6r/NIseV7I64rBW0oKUIACvvEBSnFE8TANhgIAAAAASUVORK5CYII="
+)
+
+
 def create_icon():
-    img = Image.new("RGB", (64, 64), color=(30, 144, 255))
-    d = ImageDraw.Draw(img)
-    d.ellipse((8, 8, 56, 56), fill=(255, 255, 255))
-    return img
+    from PIL import Image
+    return Image.open(io.BytesIO(ICON_PNG))
+
+
+def flush_settings():
+    global save_timer
+    with interval_lock:
+        if save_timer:
+            save_timer.cancel()
+            save_timer = None
+        save_settings(settings)
 
 
 def set_interval(value):
-    global interval_value
+    global interval_value, save_timer
     with interval_lock:
         interval_value = value
         settings["interval"] = value
-        save_settings(settings)
+        # クリックごとに書き込まず、最後の変更から一定時間後に1回だけ保存する
+        if save_timer:
+            save_timer.cancel()
+        save_timer = threading.Timer(SETTINGS_SAVE_DELAY_SEC, flush_settings)
+        save_timer.daemon = True
+        save_timer.start()
     print(f"[INFO] 記録間隔を {value} 秒に変更しました。")
 
 
 def build_menu():
+    import pystray
+
     def interval_item(sec):
         return pystray.MenuItem(
             f"{sec} sec", lambda: set_interval(sec), checked=lambda item: interval_value == sec
@@ -215,7 +508,7 @@ def build_menu():
 
     return pystray.Menu(
         pystray.MenuItem("Open Log Folder",
-                         lambda: os.startfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Logs"))),
+                         lambda: os.startfile(LOG_DIR)),
         pystray.MenuItem("Record Interval",
                          pystray.Menu(interval_item(1), interval_item(3), interval_item(5), interval_item(10))),
         pystray.MenuItem("Exit", on_exit)
@@ -223,8 +516,13 @@ def build_menu():
 
 
 def on_exit(icon, item):
-    global stop_flag, global_mutex_handle
-    stop_flag = True
+    global global_mutex_handle
+    stop_event.set()
+    wake_event.set()
+    if save_timer:
+        flush_settings()
+    if hook_thread_id:
+        user32.PostThreadMessageW(hook_thread_id, WM_QUIT, 0, 0)
 
     # ★追加：終了時にミューテックスハンドルを明示的に解放
     if global_mutex_handle:
@@ -235,6 +533,11 @@ def on_exit(icon, item):
 
 
 def main():
+    import pystray
+
+    threading.Thread(target=hook_thread, daemon=True).start()
+    w = threading.Thread(target=writer_thread, daemon=True)
+    w.start()
     t = threading.Thread(target=logger_thread, daemon=True)
     t.start()
 
@@ -244,8 +547,16 @@ def main():
         f"Activity Logger (Session {SESSION_ID})",
         menu=build_menu(),
     )
+    set_background_mode(True)
     icon.run()
 
+    # 書き込みスレッドがファイルを閉じる（バッファを書き出す）まで待つ
+    stop_event.set()
+    wake_event.set()
+    t.join(timeout=5)
+    w.join(timeout=5)
+    set_background_mode(False)
+
     # ★追加：icon.run() が終了した（＝アプリ終了時）にハンドルを解放
     global global_mutex_handle
     if global_mutex_handle: